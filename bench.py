@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import download
+
+import argparse
+import random
+import time
+
+
+import logging
+log = logging.getLogger(__file__)
+
+
+def legacyPrefix(customPrefixDict, permalink, title):
+    # Track.Filename before PrefixMatcher
+    prefix = ''
+    for key, value in customPrefixDict.items():
+        lowerKey = key.lower()
+        if lowerKey in permalink.lower() or lowerKey in title.lower():
+            if prefix:
+                raise RuntimeError('Duplicated prefix')
+            else:
+                prefix = '{}-'.format(value)
+    return prefix
+
+
+def matcherPrefix(prefixMatcher, permalink, title):
+    value = prefixMatcher.Match(permalink, title)
+    return '' if value is None else '{}-'.format(value)
+
+
+def syntheticCatalog(tracksCount, rulesCount, seed):
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    rules = {}
+    while len(rules) < rulesCount:
+        rules['lecturer{}{}'.format(len(rules), ''.join(rng.choice(letters) for _ in range(6)))] = len(rules) + 1
+    keys = sorted(rules)
+    tracks = []
+    for index in range(tracksCount):
+        words = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(8)]
+        if rng.random() < 0.8:
+            words.insert(rng.randint(0, len(words)), rng.choice(keys).upper())
+        permalink = '-'.join(words[:4]).lower() + '-{}'.format(index)
+        title = u' '.join(words)
+        tracks.append((permalink, title))
+    return rules, tracks
+
+
+def measure(prefixFunction, rules, tracks):
+    start = time.time()
+    result = [prefixFunction(rules, permalink, title) for permalink, title in tracks]
+    return time.time() - start, result
+
+
+def measureMatcher(rules, tracks):
+    # matcher is built once per playlist, building is measured too
+    start = time.time()
+    prefixMatcher = download.getPrefixMatcher(rules)
+    result = [matcherPrefix(prefixMatcher, permalink, title) for permalink, title in tracks]
+    return time.time() - start, result
+
+
+def main(args):
+    rules, tracks = syntheticCatalog(args.tracks, args.rules, args.seed)
+    log.info('Catalog of %d tracks, %d prefix rules', len(tracks), len(rules))
+    legacyTime, legacyResult = measure(legacyPrefix, rules, tracks)
+    matcherTime, matcherResult = measureMatcher(rules, tracks)
+    if legacyResult != matcherResult:
+        raise RuntimeError('Results differ')
+    log.info('Legacy loop:    %.3f seconds', legacyTime)
+    log.info('PrefixMatcher:  %.3f seconds (x%.1f)', matcherTime, legacyTime / max(matcherTime, 1e-9))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s:%(lineno)d [%(levelname)s] %(message)s'
+    )
+
+    parser = argparse.ArgumentParser('Benchmark prefix matching', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--tracks', help='Number of synthetic tracks', type=int, default=20000)
+    parser.add_argument('--rules', help='Number of prefix rules', type=int, default=50)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    main(parser.parse_args())
@@ -2,9 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
+import cProfile
+import glob
+import hashlib
 import io
 import json
+import mmap
+import multiprocessing
 import os
+import pstats
 import requests
 import shutil
 import subprocess
@@ -31,7 +38,51 @@ class DownloadError(Exception):
     pass
 
 
+class PrefixMatcher(object):
+    # All keys of customPrefixDict in one regex: lookahead finds the longest key at every position,
+    # shorter keys inside found ones are added from precomputed table, so result equals checking every key.
+    def __init__(self, prefixDict):
+        self.Values = {}
+        self.Conflicts = set()
+        for key, value in prefixDict.items():
+            lowerKey = key.lower()
+            if lowerKey in self.Values:
+                self.Conflicts.add(lowerKey)
+            self.Values[lowerKey] = value
+        self.Contained = dict(
+            (key, [other for other in self.Values if other != key and other in key])
+            for key in self.Values
+        )
+        keys = sorted(self.Values, key=len, reverse=True)
+        self.Regex = re.compile(u'(?=({}))'.format(u'|'.join(re.escape(key) for key in keys))) if keys else None
+
+    def Match(self, *texts):
+        if self.Regex is None:
+            return None
+        found = set()
+        for text in texts:
+            found.update(match.group(1) for match in self.Regex.finditer(text.lower()))
+        for key in list(found):
+            found.update(self.Contained[key])
+        if len(found) > 1 or found & self.Conflicts:
+            raise RuntimeError('Duplicated prefix')
+        return self.Values[found.pop()] if found else None
+
+
+PREFIX_MATCHERS = {}
+
+
+def getPrefixMatcher(prefixDict):
+    # tracks of one playlist share customPrefixDict, so matcher is built once per playlist
+    key = tuple(sorted(prefixDict.items()))
+    if key not in PREFIX_MATCHERS:
+        PREFIX_MATCHERS[key] = PrefixMatcher(prefixDict)
+    return PREFIX_MATCHERS[key]
+
+
 class Track(object):
+    CatalogKind = None
+
     def SetEverything(self,
         title=None,
         created=None,
@@ -52,26 +103,27 @@ class Track(object):
         self.Playlist = playlist # for hashtag
         self.AudioFormat = audioFormat
         self.CustomPrefixDict = customPrefixDict
+        self.PrefixMatcher = getPrefixMatcher(customPrefixDict) if customPrefixDict is not None else None
+        self.FilenameCache = None
 
-    def Download(self, filename):
+    def Download(self, filename, retention=None):
         raise NotImplementedError()
 
     def Filename(self):
         # Telegram needs mp3 extension to show mp4 files as audio
         # Telegram on android fails on scrolling mp4 tracks
+        if self.FilenameCache is not None:
+            return self.FilenameCache
         prefix = ''
-        if self.CustomPrefixDict is not None:
-            for key, value in self.CustomPrefixDict.iteritems():
-                lowerKey = key.lower()
-                if lowerKey in self.Permalink.lower() or lowerKey in self.Title.lower():
-                    if prefix:
-                        raise RuntimeError('Duplicated prefix')
-                    else:
-                        prefix = '{}-'.format(value)
+        if self.PrefixMatcher is not None:
+            value = self.PrefixMatcher.Match(self.Permalink, self.Title)
+            if value is not None:
+                prefix = '{}-'.format(value)
 
         basename = u'{prefix}{track.Created}-{track.Permalink}.mp3'.format(prefix=prefix, track=self).replace(':', u' —')
         log.debug('Basename is %r', basename)
-        return os.path.join(self.ArtistEng, self.Playlist, basename)
+        self.FilenameCache = os.path.join(self.ArtistEng, self.Playlist, basename)
+        return self.FilenameCache
 
     def TelegramCaption(self):
         telegramCaption = u'#{artistEng} #{playlistName} [{track.Created}] {track.Title}\n{track.PermalinkUrl}'.format(
@@ -112,38 +164,100 @@ Telegram caption:\n{telegramCaption}
             raise RuntimeError('Invalid audio format: %r' % self.AudioFormat)
         audio.save()
 
-    def Save(self, dstDir, force=None):
-        filename = os.path.join(dstDir, self.Filename())
-        if not force and os.path.exists(filename):
-            log.info('File %r exists, skipping', filename)
-            return False
-        self.Download(filename)
+    def Save(self, dstDir, force=None, index=None, retention=None):
+        relativeFilename = self.Filename()
+        filename = os.path.join(dstDir, relativeFilename)
+        if not force:
+            if index is not None and relativeFilename in index:
+                if index.IsEvicted(relativeFilename):
+                    log.info('File %r was evicted by retention, skipping', filename)
+                    return False
+                if index.IsOk(relativeFilename):
+                    log.info('File %r is in index, skipping', filename)
+                    return False
+                log.warn('File %r is broken according to index, saving again', filename)
+            elif os.path.exists(filename):
+                log.info('File %r exists, skipping', filename)
+                return False
+            if retention is not None and not retention.Admits(relativeFilename, self.Created):
+                log.info('File %r would be evicted by retention, skipping', filename)
+                return False
+        self.Download(filename, retention=retention)
         self.Tag(filename)
         log.info('File %r was saved, meta was updated', filename)
+        if index is not None:
+            entry = verifyFile((dstDir, relativeFilename))
+            entry['Created'] = self.Created
+            index.Update(entry)
+        if retention is not None:
+            retention.Apply(os.path.dirname(relativeFilename))
         return True
 
+    def CatalogRecord(self, dstDir=None, downloaded=None):
+        # Saved: file is on disk (None if dstDir is unknown), Downloaded: fetched in this run (None without --save)
+        record = {
+            'Kind': self.CatalogKind,
+            'Title': self.Title,
+            'Created': self.Created,
+            'Permalink': self.Permalink,
+            'PermalinkUrl': self.PermalinkUrl,
+            'Artist': self.Artist,
+            'ArtistEng': self.ArtistEng,
+            'Playlist': self.Playlist,
+            'AudioFormat': self.AudioFormat,
+            'CustomPrefixDict': self.CustomPrefixDict,
+            'Filename': self.Filename(),
+            'Size': None,
+            'Saved': None,
+            'Downloaded': downloaded,
+        }
+        if dstDir is not None:
+            filename = os.path.join(dstDir, record['Filename'])
+            record['Saved'] = os.path.exists(filename)
+            if record['Saved']:
+                record['Size'] = os.path.getsize(filename)
+        record.update(self.SourceFields())
+        return record
+
+    def SourceFields(self):
+        raise NotImplementedError()
+
 
-def downloadUrl(url, filename):
+def downloadUrl(url, filename, retention=None):
     log.debug('Downloading %r -> %r', url, filename)
-    response = requests.get(url)
+    response = requests.get(url, stream=True)
     statusCode = response.status_code
     if statusCode == 200:
+        if retention is not None:
+            retention.Reserve(filename, int(response.headers.get('Content-Length') or 0))
         log.debug('Got code 200, writing content')
-        with open(filename, 'w') as f:
-            f.write(response.content)
+        try:
+            with open(filename, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        except:
+            log.exception('Failed to write %r, removing partial file', filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
         log.debug('Content is ready')
     else:
         raise DownloadError('Got invalid response: %r' % statusCode)
 
 
 class SoundcloudTrack(Track):
+    CatalogKind = 'soundcloud'
+
     def __init__(self, soundcloudClient, trackId):
         self.SoundcloudClient = soundcloudClient
         self.TrackId = trackId
 
-    def Download(self, filename):
+    def SourceFields(self):
+        return {'TrackId': self.TrackId}
+
+    def Download(self, filename, retention=None):
         stream = self.SoundcloudClient.get('/tracks/{}/stream'.format(self.TrackId), allow_redirects=False)
-        downloadUrl(stream.location, filename)
+        downloadUrl(stream.location, filename, retention=retention)
 
 
 class SoundcloudDownloader(object):
@@ -212,59 +326,130 @@ def toShift(shift):
     return result
 
 
+MP4_CONVERSIONS = ['transcode', 'copy']
+
+
+def fetchVideo(url):
+    while True:
+        try:
+            return pafy.new(url)
+        except IndexError:
+            sleepTime = 1200
+            log.exception('Failed, traceback:')
+            log.info('Sleeping for %d', sleepTime)
+            time.sleep(sleepTime)
+
+
 class Mp4Track(Track):
-    def __init__(self, audioUrl, startShift=None):
+    CatalogKind = 'mp4'
+
+    def __init__(self, audioUrl=None, startShift=None, conversion='transcode'):
+        # youtube audio urls expire in hours, so None means resolving from PermalinkUrl on download
+        assert conversion in MP4_CONVERSIONS, conversion
         self.AudioUrl = audioUrl
+        self.RawStartShift = startShift
         self.StartShift = toShift(startShift)
-
-    def Download(self, filename):
-        assert self.AudioFormat == 'mp4'
-        tmpFile = filename + '.tmp'
-        downloadUrl(self.AudioUrl, tmpFile)
-        # https://github.com/Top-Dog/Python-MP4-to-MP3-Converter/blob/master/Python-MP4-to-MP3-Converter/Python-MP4-to-MP3-Converter/main.py#L109
-        bitrate = '128000'
+        self.Conversion = conversion
+        self.ConversionSeconds = None
+
+    def SourceFields(self):
+        return {
+            'AudioUrl': self.AudioUrl,
+            'StartShift': self.RawStartShift,
+            'Conversion': self.Conversion,
+            'ConversionSeconds': self.ConversionSeconds,
+        }
+
+    def ConvertCommand(self, tmpFile, filename):
         command = [
             'ffmpeg',
             '-loglevel', '0', # lower ffmeg's verbosity
-            '-i', tmpFile,
-            '-f', 'mp3',
-            '-b:a', bitrate,
-            '-ar', '44100', # output will have 44100 Hz
-            '-ac', '2', # stereo (set to '1' for mono)
-            '-vn', # no video
-            '-y', # overwrite output
         ]
-        if self.StartShift is not None:
-            command += ['-ss', self.StartShift]
-        command.append(filename)
-        log.debug('Running %r', command)
-        result = subprocess.call(command)
-        if result != 0:
-            raise 'Convert to mp3 failed'
+        if self.Conversion == 'copy':
+            # input seeking, every aac packet is a keyframe so the cut is packet-aligned
+            if self.StartShift is not None:
+                command += ['-ss', self.StartShift]
+            command += [
+                '-i', tmpFile,
+                '-f', 'mp4', # keep aac, extension is still mp3 for Telegram
+                '-c:a', 'copy',
+                '-vn', # no video
+                '-y', # overwrite output
+            ]
         else:
-            os.remove(tmpFile)
+            # https://github.com/Top-Dog/Python-MP4-to-MP3-Converter/blob/master/Python-MP4-to-MP3-Converter/Python-MP4-to-MP3-Converter/main.py#L109
+            command += [
+                '-i', tmpFile,
+                '-f', 'mp3',
+                '-b:a', '128000',
+                '-ar', '44100', # output will have 44100 Hz
+                '-ac', '2', # stereo (set to '1' for mono)
+                '-vn', # no video
+                '-y', # overwrite output
+            ]
+            if self.StartShift is not None:
+                command += ['-ss', self.StartShift]
+        command.append(filename)
+        return command
+
+    def Download(self, filename, retention=None):
+        assert self.AudioFormat == 'mp4'
+        if self.AudioUrl is None:
+            log.info('Resolving audio url from %r', self.PermalinkUrl)
+            self.AudioUrl = fetchVideo(self.PermalinkUrl).getbestaudio(preftype='m4a').url
+        tmpFile = filename + '.tmp'
+        downloadUrl(self.AudioUrl, tmpFile, retention=retention)
+        try:
+            if retention is not None:
+                # mp3 at 128 kbps is about the size of source aac
+                retention.Reserve(filename, os.path.getsize(tmpFile))
+            command = self.ConvertCommand(tmpFile, filename)
+            log.debug('Running %r', command)
+            start = time.time()
+            result = subprocess.call(command)
+            self.ConversionSeconds = time.time() - start
+            if result != 0:
+                raise DownloadError('Conversion (%s) failed with code %r' % (self.Conversion, result))
+        except:
+            log.exception('Failed to convert %r, removing partial files', tmpFile)
+            for partialFile in [filename, tmpFile]:
+                if os.path.exists(partialFile):
+                    os.remove(partialFile)
+            raise
+        os.remove(tmpFile)
+        if self.Conversion == 'transcode':
             self.AudioFormat = 'mp3'
-            log.info('Converted to mp3, bitrate is {}'.format(bitrate))
+        log.info('Converted with %s in %.1f seconds', self.Conversion, self.ConversionSeconds)
 
 
 class Mp3Track(Track):
+    CatalogKind = 'mp3'
+
     def __init__(self, audioUrl):
         self.AudioUrl = audioUrl
 
-    def Download(self, filename):
-        downloadUrl(self.AudioUrl, filename)
+    def SourceFields(self):
+        return {'AudioUrl': self.AudioUrl}
+
+    def Download(self, filename, retention=None):
+        downloadUrl(self.AudioUrl, filename, retention=retention)
 
 
 class ShlosbergLive(object):
-    def __init__(self):
-        pass
+    QuotesRe = re.compile(u'[«»]')
+    ArtistEng = 'grazhdanin-tv'
+    Playlist = 'shlosberg-live'
+    PlaylistDir = os.path.join(ArtistEng, Playlist) # key for Conversion and Retention in secrets.json
+
+    def __init__(self, conversion='transcode'):
+        self.Conversion = conversion
 
     def FormTitle(self, goodTitle, title, date, part):
         if goodTitle:
             topic = goodTitle
         else:
             if u'«' in title:
-                parts = [p for p in re.split('[«»]', title) if p]
+                parts = [p for p in self.QuotesRe.split(title) if p]
             else:
                 parts = title.split('.', 1)
             if len(parts) != 2:
@@ -283,29 +468,20 @@ class ShlosbergLive(object):
 
     def __call__(self):
         for url, part, shift, customTitle in self.Urls():
-            ok = False
             log.debug('Trying to fetch %r, %r, %r', url, part, shift)
-            while not ok:
-                try:
-                    video = pafy.new(url)
-                    ok = True
-                except IndexError:
-                    sleepTime = 1200
-                    log.exception('Failed, traceback:')
-                    log.info('Sleeping for %d', sleepTime)
-                    time.sleep(sleepTime)
+            video = fetchVideo(url)
             audio = video.getbestaudio(preftype='m4a')
             title = video.title
-            youtubeTrack = Mp4Track(audio.url, shift)
+            youtubeTrack = Mp4Track(audio.url, shift, conversion=self.Conversion)
             date = video.published[0:10]
             youtubeTrack.SetEverything(
                 title=self.FormTitle(customTitle, video.title, date, part),
                 # artist=video.author,
                 artist=u'Лев Шлосберг',
-                artistEng='grazhdanin-tv',
-                playlist='shlosberg-live',
+                artistEng=self.ArtistEng,
+                playlist=self.Playlist,
                 created=date,
-                permalink='shlosberg-live-{}'.format(part),
+                permalink='{}-{}'.format(self.Playlist, part),
                 permalinkUrl=url,
                 audioFormat='mp4',
             )
@@ -400,16 +576,98 @@ class ShlosbergLive(object):
         ]
 
 
-def dumpJson(data, index=None):
-    if index is None:
-        filename = 'tmp.json'
-    else:
-        filename = 'tmp{}.json'.format(index)
-    with io.open(filename, 'w', encoding='utf8') as jsonFile:
-        jsonFile.write(json.dumps(data, indent=4, sort_keys=True, ensure_ascii=False))
+class CatalogWriter(object):
+    # JSON lines: one record per track, written as soon as track is yielded
+    def __init__(self, filename):
+        self.Filename = filename
+        self.File = None
+        self.Count = 0
+
+    def __enter__(self):
+        if self.Filename:
+            log.info('Writing catalog to %r', self.Filename)
+            self.File = io.open(self.Filename, 'w', encoding='utf8')
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.File is not None:
+            self.File.close()
+            self.File = None
+            log.info('Catalog %r has %d records', self.Filename, self.Count)
+
+    def Write(self, track, dstDir=None, downloaded=None):
+        if self.File is None:
+            return
+        record = track.CatalogRecord(dstDir=dstDir, downloaded=downloaded)
+        self.File.write(u'{}\n'.format(json.dumps(record, sort_keys=True, ensure_ascii=False)))
+        self.File.flush()
+        self.Count += 1
+
+
+def readJsonLines(filename):
+    with io.open(filename, encoding='utf8') as catalogFile:
+        for lineNumber, line in enumerate(catalogFile, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                log.exception('Broken line %d in %r', lineNumber, filename)
+                raise
+
+
+class CatalogTracks(object):
+    def __init__(self, filename, soundcloudToken=None, profiler=None, conversions=None):
+        self.Filename = filename
+        self.SoundcloudToken = soundcloudToken
+        self.SoundcloudClient = None
+        self.Profiler = profiler or Profiler()
+        self.Conversions = conversions or {} # mp4 conversion by 'ArtistEng/Playlist', overrides recorded one
+
+    def FromRecord(self, record):
+        kind = record['Kind']
+        audioFormat = record['AudioFormat']
+        if kind == 'soundcloud':
+            if self.SoundcloudClient is None:
+                self.SoundcloudClient = soundcloud.Client(client_id=self.SoundcloudToken)
+            track = SoundcloudTrack(self.SoundcloudClient, record['TrackId'])
+        elif kind == 'mp4':
+            # recorded AudioUrl is expired by now
+            conversion = self.Conversions.get(
+                os.path.join(record['ArtistEng'], record['Playlist']),
+                record.get('Conversion', 'transcode'),
+            )
+            track = Mp4Track(None, record['StartShift'], conversion=conversion)
+            # Download converts format to 'mp3' before the record is written, but source is always mp4
+            audioFormat = 'mp4'
+        elif kind == 'mp3':
+            track = Mp3Track(record['AudioUrl'])
+        else:
+            raise RuntimeError('Invalid catalog kind: %r' % kind)
+        track.SetEverything(
+            title=record['Title'],
+            created=record['Created'],
+            permalink=record['Permalink'],
+            permalinkUrl=record['PermalinkUrl'],
+            artist=record['Artist'],
+            artistEng=record['ArtistEng'],
+            playlist=record['Playlist'],
+            audioFormat=audioFormat,
+            customPrefixDict=record['CustomPrefixDict'],
+        )
+        return track
+
+    def __call__(self, args):
+        log.info('Getting tracks from catalog %r', self.Filename)
+        for record in self.Profiler.Iterate('catalog', readJsonLines(self.Filename)):
+            yield self.FromRecord(record)
 
 
 class Meduza(object):
+    TermsRe = re.compile(r'.*/audio/\d+/episodes/([\d/]+)/(.*)\.mp3\?client=native.*')
+    AudioRe = re.compile(r'href="(.*)\?client=native.*')
+
     def __init__(self):
         pass
 
@@ -426,10 +684,8 @@ class Meduza(object):
             for line in text.split(' '):
                 if '/audio/' in line:
                     try:
-                        termsRe = '.*/audio/\d+/episodes/([\d/]+)/(.*)\.mp3\?client=native.*'
-                        audioRe = 'href="(.*)\?client=native.*'
-                        terms = re.search(termsRe, line)
-                        audio = re.search(audioRe, line)
+                        terms = self.TermsRe.search(line)
+                        audio = self.AudioRe.search(line)
                         audioUrl = 'https://meduza.io{}'.format(audio.group(1))
                         log.debug('%r', [audioUrl, terms.group(1), terms.group(2)])
                     except:
@@ -509,38 +765,537 @@ class OpenUniversity(object):
                 yield track
 
 
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+
+def parseMp3FrameHeader(header):
+    # returns (frame length in bytes, samples, sample rate) or None for invalid header
+    b0, b1, b2, b3 = bytearray(header)
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((b1 >> 3) & 3)
+    layer = {1: 3, 2: 2, 3: 1}.get((b1 >> 1) & 3)
+    bitrateIndex = b2 >> 4
+    sampleRateIndex = (b2 >> 2) & 3
+    if version is None or layer is None or bitrateIndex in (0, 15) or sampleRateIndex == 3:
+        return None
+    bitrate = MP3_BITRATES[(min(version, 2), layer)][bitrateIndex] * 1000
+    sampleRate = MP3_SAMPLE_RATES[version][sampleRateIndex]
+    padding = (b2 >> 1) & 1
+    if layer == 1:
+        return (12 * bitrate // sampleRate + padding) * 4, 384, sampleRate
+    samples = 576 if layer == 3 and version != 1 else 1152
+    return samples // 8 * bitrate // sampleRate + padding, samples, sampleRate
+
+
+def xingFrames(data, start):
+    # frames count from Xing/Info header of the first frame, None if missing
+    b0, b1, b2, b3 = bytearray(data[start:start + 4])
+    isV1 = ((b1 >> 3) & 3) == 3
+    isMono = (b3 >> 6) == 3
+    offset = start + 4 + {(True, False): 32, (True, True): 17, (False, False): 17, (False, True): 9}[(isV1, isMono)]
+    if data[offset:offset + 4] not in (b'Xing', b'Info'):
+        return None
+    flags = bytearray(data[offset + 4:offset + 8])
+    if not flags[3] & 1:
+        return None
+    count = bytearray(data[offset + 8:offset + 12])
+    return (count[0] << 24) | (count[1] << 16) | (count[2] << 8) | count[3]
+
+
+def scanMp3(data):
+    # errors mean broken download, warnings come from the source file and would not go away on download
+    size = len(data)
+    errors, warnings = [], []
+    position = 0
+    if data[0:3] == b'ID3' and size >= 10:
+        sizeBytes = bytearray(data[6:10])
+        position = 10 + ((sizeBytes[0] << 21) | (sizeBytes[1] << 14) | (sizeBytes[2] << 7) | sizeBytes[3])
+    end = size - 128 if size >= 128 and data[size - 128:size - 125] == b'TAG' else size
+    frames, duration, skipped, expectedFrames = 0, 0., 0, None
+    while position + 4 <= end:
+        header = parseMp3FrameHeader(data[position:position + 4])
+        if header is None:
+            nextPosition = data.find(b'\xff', position + 1, end)
+            if nextPosition == -1:
+                nextPosition = end
+            skipped += nextPosition - position
+            position = nextPosition
+            continue
+        frameLength, samples, sampleRate = header
+        if position + frameLength > end:
+            errors.append('Truncated last frame at %d' % position)
+            break
+        if frames == 0:
+            expectedFrames = xingFrames(data, position)
+        frames += 1
+        duration += float(samples) / sampleRate
+        position += frameLength
+    if frames == 0:
+        errors.append('No mp3 frames')
+    if skipped > 4096:
+        warnings.append('Skipped %d bytes of garbage' % skipped)
+    # Xing frames count may or may not include Xing frame itself
+    if expectedFrames is not None and abs(expectedFrames - frames) > 1:
+        warnings.append('Expected %d frames, got %d' % (expectedFrames, frames))
+    return frames, duration, errors, warnings
+
+
+def verifyFile(args):
+    # runs in worker process, so gets a single tuple
+    root, relativeFilename = args
+    filename = os.path.join(root, relativeFilename)
+    stat = os.stat(filename)
+    entry = {
+        'Path': relativeFilename,
+        'Size': stat.st_size,
+        'Mtime': stat.st_mtime,
+        'Md5': None,
+        'Duration': None,
+        'Frames': None,
+        'Artist': None,
+        'Title': None,
+        'Errors': [], # file should be downloaded again
+        'Warnings': [], # reported by --verify only
+    }
+    if stat.st_size == 0:
+        entry['Errors'].append('Empty file')
+        return entry
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            md5 = hashlib.md5()
+            chunkSize = 1 << 20
+            for offset in range(0, stat.st_size, chunkSize):
+                md5.update(data[offset:offset + chunkSize])
+            entry['Md5'] = md5.hexdigest()
+            isMp4 = data[4:8] == b'ftyp' # stream copied aac with mp3 extension
+            if not isMp4:
+                entry['Frames'], entry['Duration'], entry['Errors'], entry['Warnings'] = scanMp3(data)
+        finally:
+            data.close()
+    try:
+        audio = mutagen.File(filename, easy=True)
+        if isMp4:
+            if audio is None or not audio.info.length:
+                entry['Errors'].append('Broken mp4')
+            else:
+                entry['Duration'] = audio.info.length
+        if audio is not None and audio.tags is not None:
+            entry['Artist'] = audio.tags.get('artist', [None])[0]
+            entry['Title'] = audio.tags.get('title', [None])[0]
+    except Exception as e:
+        if isMp4:
+            entry['Errors'].append('Broken mp4: %s' % e)
+        else:
+            entry['Warnings'].append('Broken tags: %s' % e)
+    if entry['Artist'] is None or entry['Title'] is None:
+        entry['Warnings'].append('Missing tags')
+    return entry
+
+
+def episodeOrder(entry):
+    # episode date (Track.Created) when known, download date otherwise
+    created = entry.get('Created') or time.strftime('%Y-%m-%d', time.localtime(entry['Mtime']))
+    return created, entry['Mtime']
+
+
+def episodeTime(entry):
+    created = entry.get('Created')
+    if not created:
+        return entry['Mtime']
+    try:
+        return time.mktime(time.strptime(created[:10], '%Y-%m-%d'))
+    except ValueError:
+        return None # not a date, e.g. OpenUni lesson number
+
+
+class ArchiveIndex(object):
+    # path, size, mtime, hash, duration and errors of every file in download tree
+    def __init__(self, filename):
+        self.Filename = filename
+        self.Entries = {}
+        self.Changed = False
+        if filename and os.path.exists(filename):
+            for entry in readJsonLines(filename):
+                self.Entries[entry['Path']] = entry
+            log.info('Loaded %d entries from index %r', len(self.Entries), filename)
+
+    def __contains__(self, relativeFilename):
+        return relativeFilename in self.Entries
+
+    def Get(self, relativeFilename):
+        return self.Entries.get(relativeFilename)
+
+    def IsOk(self, relativeFilename):
+        entry = self.Entries.get(relativeFilename)
+        return entry is not None and not entry['Errors']
+
+    def IsEvicted(self, relativeFilename):
+        entry = self.Entries.get(relativeFilename)
+        return entry is not None and entry.get('Evicted', False)
+
+    def Stored(self, playlistDir=None):
+        # entries of files on disk, oldest episodes first
+        entries = [
+            entry for path, entry in self.Entries.items()
+            if not entry.get('Evicted', False) and (playlistDir is None or os.path.dirname(path) == playlistDir)
+        ]
+        return sorted(entries, key=episodeOrder)
+
+    def Evict(self, relativeFilename):
+        # entry is kept to prevent downloading the file again
+        self.Entries[relativeFilename]['Evicted'] = True
+        self.Changed = True
+
+    def Update(self, entry):
+        self.Entries[entry['Path']] = entry
+        self.Changed = True
+
+    def Remove(self, relativeFilename):
+        del self.Entries[relativeFilename]
+        self.Changed = True
+
+    def Save(self):
+        if not self.Filename or not self.Changed:
+            return
+        tmpFile = self.Filename + '.tmp'
+        with io.open(tmpFile, 'w', encoding='utf8') as indexFile:
+            for path in sorted(self.Entries):
+                indexFile.write(u'{}\n'.format(json.dumps(self.Entries[path], sort_keys=True, ensure_ascii=False)))
+        os.rename(tmpFile, self.Filename)
+        self.Changed = False
+        log.info('Saved %d entries to index %r', len(self.Entries), self.Filename)
+
+
+def stopWorkerTracing():
+    # pool workers are forked from main process with tracemalloc inherited when profiling
+    try:
+        import tracemalloc
+    except ImportError:
+        return
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def verifyArchive(downloadPath, index, processes=None, catalogFilename=None, profiler=None):
+    # unicode root makes glob return unicode paths, same as Track.Filename() keys
+    if isinstance(downloadPath, bytes):
+        downloadPath = downloadPath.decode('utf8')
+    onDisk = set()
+    toScan = []
+    for filename in glob.glob(os.path.join(downloadPath, u'*', u'*', u'*.mp3')):
+        relativeFilename = os.path.relpath(filename, downloadPath)
+        onDisk.add(relativeFilename)
+        entry = index.Get(relativeFilename)
+        stat = os.stat(filename)
+        # entries without Warnings are from older index where every problem was an error
+        if entry is None or entry.get('Evicted', False) or 'Warnings' not in entry or entry['Mtime'] != stat.st_mtime or entry['Size'] != stat.st_size:
+            toScan.append(relativeFilename)
+    for relativeFilename in list(index.Entries):
+        if relativeFilename not in onDisk and not index.IsEvicted(relativeFilename):
+            log.info('File %r was removed, dropping from index', relativeFilename)
+            index.Remove(relativeFilename)
+    log.info('Found %d files, %d of them are new or changed', len(onDisk), len(toScan))
+
+    if toScan:
+        # workers are not profiled, so they must not inherit enabled cProfile
+        with (profiler or Profiler()).Paused():
+            pool = multiprocessing.Pool(processes, initializer=stopWorkerTracing)
+        try:
+            for entry in pool.imap_unordered(verifyFile, [(downloadPath, f) for f in toScan], chunksize=4):
+                previous = index.Get(entry['Path'])
+                if previous is not None and previous.get('Created'):
+                    entry['Created'] = previous['Created']
+                index.Update(entry)
+        finally:
+            pool.close()
+            pool.join()
+
+    broken, suspicious = 0, 0
+    stored = index.Stored()
+    for entry in stored:
+        path = entry['Path']
+        if entry['Errors']:
+            broken += 1
+            log.warn(u'File %r is broken: %s', path, u'; '.join(entry['Errors']))
+        if entry.get('Warnings'):
+            suspicious += 1
+            log.warn(u'File %r has warnings: %s', path, u'; '.join(entry['Warnings']))
+
+    mismatched = 0
+    if catalogFilename:
+        for record in readJsonLines(catalogFilename):
+            entry = index.Get(record['Filename'])
+            if entry is None:
+                log.warn(u'File %r from catalog is missing', record['Filename'])
+                continue
+            if entry.get('Created') != record['Created']:
+                entry['Created'] = record['Created']
+                index.Changed = True
+            if entry.get('Evicted', False):
+                continue
+            for field in ['Artist', 'Title']:
+                if entry[field] != record[field]:
+                    mismatched += 1
+                    log.warn(u'File %r has %s tag %r, expected %r', entry['Path'], field, entry[field], record[field])
+
+    log.info(
+        'Verified %d files, %d of them are broken, %d have warnings, %d tags differ from catalog',
+        len(stored), broken, suspicious, mismatched,
+    )
+    return broken
+
+
+class Retention(object):
+    # Config in secrets.json, playlists are keyed by 'ArtistEng/Playlist' directory:
+    # "Retention": {"MinFreeMb": 1024, "Playlists": {"grazhdanin-tv/shlosberg-live": {"KeepLast": 20, "MaxAgeDays": 365, "MaxSizeMb": 2048}}}
+    # Only files from the index of playlists with policy are eligible for eviction, oldest episodes first:
+    # episode date is saved to the index by Track.Save or taken from catalog by --verify.
+    def __init__(self, downloadPath, index, config):
+        self.DownloadPath = downloadPath
+        self.Index = index
+        self.MinFree = config.get('MinFreeMb', 0) * 1024 * 1024
+        self.Policies = config.get('Playlists', {})
+
+    def FreeSpace(self):
+        stat = os.statvfs(self.DownloadPath)
+        return stat.f_bavail * stat.f_frsize
+
+    def Evict(self, entry, reason):
+        filename = os.path.join(self.DownloadPath, entry['Path'])
+        log.info('Evicting %r (%d bytes): %s', filename, entry['Size'], reason)
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.Index.Evict(entry['Path'])
+
+    def Eligible(self, exclude=None):
+        # playlists are mixed, so Created strings are not comparable (OpenUni lesson numbers vs dates):
+        # episode date is used only when Created is a date, download time otherwise
+        entries = [
+            entry for entry in self.Index.Stored()
+            if os.path.dirname(entry['Path']) in self.Policies and entry['Path'] != exclude
+        ]
+        return sorted(entries, key=lambda entry: (episodeTime(entry) or entry['Mtime'], entry['Mtime']))
+
+    def Admits(self, relativeFilename, created):
+        # False if file would be evicted right after saving
+        policy = self.Policies.get(os.path.dirname(relativeFilename))
+        if policy is None:
+            return True
+        entry = {'Path': relativeFilename, 'Created': created, 'Mtime': time.time()}
+        maxAgeDays = policy.get('MaxAgeDays')
+        if maxAgeDays is not None:
+            entryTime = episodeTime(entry)
+            if entryTime is not None and entryTime < time.time() - maxAgeDays * 24 * 3600:
+                return False
+        keepLast = policy.get('KeepLast')
+        if keepLast is not None:
+            entries = [other for other in self.Index.Stored(os.path.dirname(relativeFilename)) if other['Path'] != relativeFilename]
+            if keepLast == 0 or (len(entries) >= keepLast and episodeOrder(entry) < episodeOrder(entries[-keepLast])):
+                return False
+        return True
+
+    def Reserve(self, filename, size):
+        relativeFilename = os.path.relpath(filename, self.DownloadPath)
+        playlistDir = os.path.dirname(relativeFilename)
+        maxSizeMb = self.Policies.get(playlistDir, {}).get('MaxSizeMb')
+        if maxSizeMb is not None:
+            # nothing is evicted if the file would not fit anyway
+            quota = maxSizeMb * 1024 * 1024
+            if size > quota:
+                raise DownloadError('File of %d bytes exceeds quota of %r' % (size, playlistDir))
+            entries = [entry for entry in self.Index.Stored(playlistDir) if entry['Path'] != relativeFilename]
+            used = sum(entry['Size'] for entry in entries)
+            while used + size > quota:
+                entry = entries.pop(0)
+                self.Evict(entry, 'quota of %r' % playlistDir)
+                used -= entry['Size']
+
+        need = size + self.MinFree
+        entries = self.Eligible(exclude=relativeFilename)
+        free = self.FreeSpace()
+        if free + sum(entry['Size'] for entry in entries) < need:
+            raise DownloadError('Not enough space for %r: need %d bytes, have %d' % (filename, need, free))
+        while entries and self.FreeSpace() < need:
+            self.Evict(entries.pop(0), 'free space')
+        free = self.FreeSpace()
+        if free < need: # sizes in index may be stale
+            raise DownloadError('Not enough space for %r: need %d bytes, have %d' % (filename, need, free))
+        log.debug('Reserved %d bytes for %r', size, filename)
+
+    def Apply(self, playlistDir):
+        policy = self.Policies.get(playlistDir)
+        if policy is None:
+            return
+        entries = self.Index.Stored(playlistDir)
+        maxAgeDays = policy.get('MaxAgeDays')
+        if maxAgeDays is not None:
+            minTime = time.time() - maxAgeDays * 24 * 3600
+            kept = []
+            for entry in entries:
+                entryTime = episodeTime(entry)
+                if entryTime is not None and entryTime < minTime:
+                    self.Evict(entry, 'older than %d days' % maxAgeDays)
+                else:
+                    kept.append(entry)
+            entries = kept
+        keepLast = policy.get('KeepLast')
+        if keepLast is not None:
+            while len(entries) > keepLast:
+                self.Evict(entries.pop(0), 'keeping last %d' % keepLast)
+        maxSizeMb = policy.get('MaxSizeMb')
+        if maxSizeMb is not None:
+            quota = maxSizeMb * 1024 * 1024
+            used = sum(entry['Size'] for entry in entries)
+            while len(entries) > 1 and used > quota:
+                entry = entries.pop(0)
+                self.Evict(entry, 'quota of %r' % playlistDir)
+                used -= entry['Size']
+
+
+class Profiler(object):
+    # cProfile for the whole run, wall time and traced memory accumulated per stage,
+    # top allocations from tracemalloc snapshot at the end
+    def __init__(self, filename=None, top=20):
+        self.Filename = filename
+        self.Top = top
+        self.CpuProfile = None
+        self.Tracemalloc = None
+        self.StageNames = []
+        self.StageStats = {}
+
+    def __enter__(self):
+        if not self.Filename:
+            return self
+        log.info('Profiling to %r', self.Filename)
+        try:
+            import tracemalloc # python 3.4+ or pytracemalloc for python 2
+            self.Tracemalloc = tracemalloc
+            self.Tracemalloc.start()
+        except ImportError:
+            log.warn('No tracemalloc module, memory will not be profiled')
+        self.CpuProfile = cProfile.Profile()
+        self.CpuProfile.enable()
+        return self
+
+    def TracedMemory(self):
+        return self.Tracemalloc.get_traced_memory()[0] if self.Tracemalloc is not None else 0
+
+    @contextlib.contextmanager
+    def Stage(self, name):
+        if self.CpuProfile is None:
+            yield
+            return
+        start, startMemory = time.time(), self.TracedMemory()
+        try:
+            yield
+        finally:
+            if name not in self.StageStats:
+                self.StageNames.append(name)
+                self.StageStats[name] = [0, 0., 0]
+            stats = self.StageStats[name]
+            stats[0] += 1
+            stats[1] += time.time() - start
+            stats[2] += self.TracedMemory() - startMemory
+
+    @contextlib.contextmanager
+    def Paused(self):
+        if self.CpuProfile is None:
+            yield
+            return
+        self.CpuProfile.disable()
+        try:
+            yield
+        finally:
+            self.CpuProfile.enable()
+
+    def Iterate(self, name, iterable):
+        # only producing items is measured, not the work done by consumer while generator is paused
+        if not self.Filename:
+            return iterable
+        return self.IterateStage(name, iter(iterable))
+
+    def IterateStage(self, name, iterator):
+        while True:
+            with self.Stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.CpuProfile is None:
+            return
+        self.CpuProfile.disable()
+        self.CpuProfile.dump_stats(self.Filename)
+        log.info('Profile was saved to %r, top %d functions:', self.Filename, self.Top)
+        stream = io.BytesIO() if str is bytes else io.StringIO()
+        stats = pstats.Stats(self.CpuProfile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.Top)
+        log.info('\n%s', stream.getvalue())
+        for name in self.StageNames:
+            calls, seconds, memory = self.StageStats[name]
+            log.info('Stage %r: %d calls, %.2f seconds, %+d bytes of traced memory', name, calls, seconds, memory)
+        if self.Tracemalloc is not None:
+            log.info('Top %d allocations:', self.Top)
+            for statistic in self.Tracemalloc.take_snapshot().statistics('lineno')[:self.Top]:
+                log.info('  %s', statistic)
+            self.Tracemalloc.stop()
+        self.CpuProfile = None
+
+
 class AllTracks(object):
-    def __init__(self, soundcloudToken=None):
+    def __init__(self, soundcloudToken=None, profiler=None, conversions=None):
         self.SoundcloudToken = soundcloudToken
+        self.Profiler = profiler or Profiler()
+        self.Conversions = conversions or {} # mp4 conversion by 'ArtistEng/Playlist'
+
+    def Soundcloud(self):
+        soundcloudDownloader = SoundcloudDownloader(self.SoundcloudToken)
+        for playlistUrl, playlistName, customPrefixDict in soundcloudDownloader.Sets():
+            for track in soundcloudDownloader(
+                playlistUrl,
+                playlistName=playlistName,
+                customPrefixDict=customPrefixDict
+            ):
+                yield track
 
     def __call__(self, args):
         if args.soundcloud:
             log.info('Getting soundcloud tracks')
-            soundcloudDownloader = SoundcloudDownloader(self.SoundcloudToken)
-            for playlistUrl, playlistName, customPrefixDict in soundcloudDownloader.Sets():
-                for track in soundcloudDownloader(
-                    playlistUrl,
-                    playlistName=playlistName,
-                    customPrefixDict=customPrefixDict
-                ):
-                    yield track
+            for track in self.Profiler.Iterate('soundcloud', self.Soundcloud()):
+                yield track
 
         if args.shlosberg_live:
             log.info('Getting Shlosberg tracks')
-            shlosbergLive = ShlosbergLive()
-            for track in shlosbergLive():
+            shlosbergLive = ShlosbergLive(conversion=self.Conversions.get(ShlosbergLive.PlaylistDir, 'transcode'))
+            for track in self.Profiler.Iterate('shlosberg-live', shlosbergLive()):
                 yield track
 
         if args.openuni:
             log.info('Getting OpenUni tracks')
             openUni = OpenUniversity()
-            for track in openUni():
+            for track in self.Profiler.Iterate('openuni', openUni()):
                 yield track
 
         if args.meduza:
             log.info('Getting Meduza')
             meduza = Meduza()
-            for track in meduza():
+            for track in self.Profiler.Iterate('meduza', meduza()):
                 yield track
 
 
@@ -548,19 +1303,64 @@ def main(args):
     log.info('Main')
     with io.open(args.secrets) as f:
         secrets = json.load(f)
-    saved, checked = 0, 0
+    saved, checked, failed = 0, 0, 0
     downloadPath = os.path.join(os.sep, *secrets['DownloadPath'])
     log.info('Saving files to %r', downloadPath)
-    allTracks = AllTracks(soundcloudToken=secrets['SoundcloudToken'])
-    for track in allTracks(args):
-        logMessage = track.LogMessage()
-        log.info(logMessage)
-        checked += 1
-        if args.save:
-            saved += int(track.Save(downloadPath, force=args.force))
-        else:
-            log.info('File wasn\'t saved')
-    log.info('Checked %d files, saved %d of them', checked, saved)
+    conversions = secrets.get('Conversion', {})
+    for playlistDir, conversion in sorted(conversions.items()):
+        if conversion not in MP4_CONVERSIONS:
+            raise RuntimeError('Invalid conversion %r for %r in %r, expected one of %r' % (conversion, playlistDir, args.secrets, MP4_CONVERSIONS))
+    index = ArchiveIndex(args.index)
+    retention = Retention(downloadPath, index, secrets['Retention']) if 'Retention' in secrets else None
+    profiler = Profiler(args.profile, top=args.profile_top)
+    if args.verify:
+        # only the main process is profiled, files are scanned in pool workers
+        with profiler:
+            with profiler.Stage('verify'):
+                verifyArchive(downloadPath, index, processes=args.processes, catalogFilename=args.from_catalog, profiler=profiler)
+            with profiler.Stage('retention'):
+                if retention is not None:
+                    for playlistDir in sorted(retention.Policies):
+                        retention.Apply(playlistDir)
+        index.Save()
+        return
+    if args.from_catalog:
+        allTracks = CatalogTracks(
+            args.from_catalog,
+            soundcloudToken=secrets['SoundcloudToken'],
+            profiler=profiler,
+            conversions=conversions,
+        )
+    else:
+        allTracks = AllTracks(
+            soundcloudToken=secrets['SoundcloudToken'],
+            profiler=profiler,
+            conversions=conversions,
+        )
+    try:
+        with profiler, CatalogWriter(args.catalog) as catalogWriter:
+            for track in allTracks(args):
+                logMessage = track.LogMessage()
+                log.info(logMessage)
+                checked += 1
+                isSaved = None
+                if args.save:
+                    try:
+                        with profiler.Stage('save'):
+                            isSaved = track.Save(downloadPath, force=args.force, index=index, retention=retention)
+                    except DownloadError as e:
+                        # e.g. quota or disk full, other tracks may still fit
+                        log.error(u'Failed to save %r: %s', track.Filename(), e)
+                        isSaved = False
+                        failed += 1
+                    saved += int(isSaved)
+                else:
+                    log.info('File wasn\'t saved')
+                catalogWriter.Write(track, dstDir=downloadPath, downloaded=isSaved)
+    finally:
+        # evictions and saved files must get to the index even if the run fails
+        index.Save()
+    log.info('Checked %d files, saved %d of them, failed %d', checked, saved, failed)
 
 
 def CreateArgumentsParser():
@@ -571,12 +1371,25 @@ def CreateArgumentsParser():
     saveGroup.add_argument('--save', help='Actually save files', action='store_true')
     saveGroup.add_argument('--force', help='Force save even for existing files', action='store_true')
 
+    verifyGroup = parser.add_argument_group('Archive index arguments')
+    verifyGroup.add_argument('--index', help='Index of downloaded files, used instead of checking files on disk', default='index.jsonl')
+    verifyGroup.add_argument('--verify', help='Verify downloaded files and update index, tags are compared with --from-catalog', action='store_true')
+    verifyGroup.add_argument('--processes', help='Number of verifying processes, defaults to cpu count', type=int)
+
+    catalogGroup = parser.add_argument_group('Catalog arguments')
+    catalogGroup.add_argument('--catalog', help='Write JSON lines catalog of all tracks to this file')
+    catalogGroup.add_argument('--from-catalog', help='Read tracks from JSON lines catalog instead of crawling')
+
     podcastsGroup = parser.add_argument_group('Podcasts arguments')
     podcastsGroup.add_argument('--soundcloud', help='Soundcloud', action='store_true')
     podcastsGroup.add_argument('--shlosberg-live', help='Shlosberg Live', action='store_true')
     podcastsGroup.add_argument('--openuni', help='Open University', action='store_true')
     podcastsGroup.add_argument('--meduza', help='Meduza', action='store_true')
 
+    profilingGroup = parser.add_argument_group('Profiling arguments')
+    profilingGroup.add_argument('--profile', help='Profile CPU and memory, write cProfile stats to this file')
+    profilingGroup.add_argument('--profile-top', help='Number of top functions and allocations to log', type=int, default=20)
+
     loggingGroup = parser.add_argument_group('Logging arguments')
     loggingGroup.add_argument('--log-format', help='Logging str', default='%(asctime)s %(module)20s:%(lineno)-3d %(levelname)-8s %(message)s')
     loggingGroup.add_argument('--log-separator', help='Logging string separator', choices=['space', 'tab'], default='space')
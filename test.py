@@ -3,6 +3,11 @@
 
 import download
 
+import os
+import shutil
+import tempfile
+import time
+
 
 import logging
 log = logging.getLogger(__file__)
@@ -187,6 +192,257 @@ def test_ParseTitle():
             raise RuntimeError('Broken test')
 
 
+def test_CatalogRoundTrip():
+    track = download.Mp4Track('https://example.com/audio.m4a', '0:37')
+    track.SetEverything(
+        title=u'Live #81. Итоги (2018/09/10)',
+        created='2018-09-10',
+        permalink='shlosberg-live-81',
+        permalinkUrl='https://www.youtube.com/watch?v=x5xbgbjNics',
+        artist=u'Лев Шлосберг',
+        artistEng='grazhdanin-tv',
+        playlist='shlosberg-live',
+        audioFormat='mp4',
+    )
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, 'catalog.jsonl')
+        with download.CatalogWriter(filename) as catalogWriter:
+            catalogWriter.Write(track, dstDir=tmpDir)
+        records = list(download.readJsonLines(filename))
+        assert len(records) == 1
+        assert records[0]['Saved'] is False
+        assert records[0]['Downloaded'] is None
+        assert records[0]['Size'] is None
+        loaded = download.CatalogTracks(filename).FromRecord(records[0])
+        assert loaded.AudioUrl is None
+        loaded.AudioUrl = track.AudioUrl
+        assert loaded.CatalogRecord() == track.CatalogRecord()
+        assert loaded.StartShift == '37'
+
+        track.AudioFormat = 'mp3' # as after Mp4Track.Download with transcode
+        os.makedirs(os.path.join(tmpDir, 'grazhdanin-tv', 'shlosberg-live'))
+        with open(os.path.join(tmpDir, track.Filename()), 'wb') as f:
+            f.write(b'x' * 417)
+        with download.CatalogWriter(filename) as catalogWriter:
+            catalogWriter.Write(track, dstDir=tmpDir, downloaded=True)
+            catalogWriter.Write(track, dstDir=tmpDir, downloaded=False) # skipped by --save as existing
+        records = list(download.readJsonLines(filename))
+        for record, downloaded in zip(records, [True, False]):
+            assert record['AudioFormat'] == 'mp3'
+            assert record['Saved'] is True
+            assert record['Size'] == 417
+            assert record['Downloaded'] is downloaded
+        record = records[0]
+        loaded = download.CatalogTracks(filename).FromRecord(record)
+        assert loaded.AudioFormat == 'mp4'
+        assert loaded.Conversion == 'transcode'
+        conversions = {os.path.join('grazhdanin-tv', 'shlosberg-live'): 'copy'}
+        loaded = download.CatalogTracks(filename, conversions=conversions).FromRecord(record)
+        assert loaded.Conversion == 'copy'
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_ScanMp3():
+    frame = b'\xff\xfb\x90\x00' + b'\x00' * 413 # MPEG 1 Layer III, 128 kbps, 44100 Hz
+    frames, duration, errors, warnings = download.scanMp3(frame * 100)
+    assert frames == 100
+    assert abs(duration - 100 * 1152. / 44100) < 1e-6
+    assert errors == []
+    assert warnings == []
+
+    frames, duration, errors, warnings = download.scanMp3((frame * 100)[:-100])
+    assert frames == 99
+    assert errors == ['Truncated last frame at 41283']
+
+    frames, duration, errors, warnings = download.scanMp3(frame * 50 + b'APETAGEX' * 1000 + frame * 50)
+    assert frames == 100
+    assert errors == []
+    assert warnings == ['Skipped 8000 bytes of garbage']
+
+
+def test_VerifyArchiveUnicodePath():
+    frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+    tmpDir = tempfile.mkdtemp()
+    try:
+        relativeFilename = os.path.join(u'openuni', u'1-culture-as-polytics', u'01-Лекция — тест.mp3')
+        os.makedirs(os.path.join(tmpDir, os.path.dirname(relativeFilename)))
+        with open(os.path.join(tmpDir, relativeFilename), 'wb') as f:
+            f.write(frame * 10)
+        indexFilename = os.path.join(tmpDir, 'index.jsonl')
+        index = download.ArchiveIndex(indexFilename)
+        download.verifyArchive(tmpDir, index, processes=1)
+        assert relativeFilename in index
+        index.Save()
+
+        index = download.ArchiveIndex(indexFilename)
+        assert relativeFilename in index
+        assert index.Get(relativeFilename)['Frames'] == 10
+        assert index.IsOk(relativeFilename) # missing tags is only a warning
+        download.verifyArchive(tmpDir, index, processes=1)
+        assert not index.Changed
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_RetentionKeepLast():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        playlistDir = os.path.join('openuni', '1-culture-as-polytics')
+        os.makedirs(os.path.join(tmpDir, playlistDir))
+        index = download.ArchiveIndex(None)
+        for number in range(5):
+            path = os.path.join(playlistDir, '{:02}.mp3'.format(number))
+            with open(os.path.join(tmpDir, path), 'wb') as f:
+                f.write(b'x')
+            index.Update({'Path': path, 'Size': 1, 'Mtime': 1000 + number, 'Errors': []})
+        retention = download.Retention(tmpDir, index, {'Playlists': {playlistDir: {'KeepLast': 2}}})
+        retention.Apply(playlistDir)
+        assert [os.path.basename(entry['Path']) for entry in index.Stored()] == ['03.mp3', '04.mp3']
+        assert sorted(os.listdir(os.path.join(tmpDir, playlistDir))) == ['03.mp3', '04.mp3']
+        assert index.IsEvicted(os.path.join(playlistDir, '00.mp3'))
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_Mp4ConvertCommand():
+    track = download.Mp4Track('https://example.com/audio.m4a', '0:37', conversion='copy')
+    command = track.ConvertCommand('in.tmp', 'out.mp3')
+    assert command.index('-ss') < command.index('-i')
+    assert command[command.index('-c:a') + 1] == 'copy'
+    assert command[command.index('-f') + 1] == 'mp4'
+
+    track = download.Mp4Track('https://example.com/audio.m4a', '0:37')
+    command = track.ConvertCommand('in.tmp', 'out.mp3')
+    assert command.index('-ss') > command.index('-i')
+    assert command[command.index('-f') + 1] == 'mp3'
+    assert '-c:a' not in command
+
+
+class FullRetention(object):
+    def Reserve(self, filename, size):
+        raise download.DownloadError('Not enough space')
+
+
+def test_Mp4ReserveFailureRemovesTmpFile():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, 'q.mp3')
+        track = download.Mp4Track('https://example.com/audio.m4a')
+        track.SetEverything(artistEng='grazhdanin-tv', audioFormat='mp4')
+        originalDownloadUrl = download.downloadUrl
+        def fakeDownloadUrl(url, filename, retention=None):
+            with open(filename, 'wb') as f:
+                f.write(b'aac')
+        download.downloadUrl = fakeDownloadUrl
+        try:
+            track.Download(filename, retention=FullRetention())
+        except download.DownloadError:
+            pass
+        else:
+            raise RuntimeError('No reservation error')
+        finally:
+            download.downloadUrl = originalDownloadUrl
+        assert os.listdir(tmpDir) == []
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_PrefixMatcher():
+    matcher = download.PrefixMatcher({'Zorin': 3, 'shulman': 6, 'man': 9})
+    assert matcher.Match('lecture-zorin-1', u'Лекция') == 3
+    assert matcher.Match('lecture-1', u'Андрей ZORIN') == 3
+    assert matcher.Match('lecture-1', u'Лекция') is None
+    for texts in [('zorin-shulman', u''), ('zorin', u'man'), ('shulman', u'')]:
+        try:
+            matcher.Match(*texts)
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError('No duplicated prefix for %r' % (texts,))
+    assert download.getPrefixMatcher({'zorin': 3}) is download.getPrefixMatcher({'zorin': 3})
+
+
+def test_RetentionReserveOverQuota():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        playlistDir = os.path.join('openuni', '1-culture-as-polytics')
+        os.makedirs(os.path.join(tmpDir, playlistDir))
+        index = download.ArchiveIndex(None)
+        for number in range(3):
+            path = os.path.join(playlistDir, '{:02}.mp3'.format(number))
+            with open(os.path.join(tmpDir, path), 'wb') as f:
+                f.write(b'x')
+            index.Update({'Path': path, 'Size': 1, 'Mtime': 1000 + number, 'Errors': [], 'Created': '{:02}'.format(number)})
+        retention = download.Retention(tmpDir, index, {'Playlists': {playlistDir: {'MaxSizeMb': 1}}})
+        try:
+            retention.Reserve(os.path.join(tmpDir, playlistDir, 'new.mp3'), 5 * 1024 * 1024)
+        except download.DownloadError:
+            pass
+        else:
+            raise RuntimeError('No quota error')
+        assert len(os.listdir(os.path.join(tmpDir, playlistDir))) == 3
+        assert len(index.Stored()) == 3
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_RetentionEligibleAcrossPlaylists():
+    index = download.ArchiveIndex(None)
+    now = time.time()
+    for path, created, mtime in [
+        (os.path.join('openuni', '1-culture-as-polytics', '01.mp3'), '01', now),
+        (os.path.join('grazhdanin-tv', 'shlosberg-live', 'old.mp3'), '2017-06-01', now),
+        (os.path.join('grazhdanin-tv', 'shlosberg-live', 'new.mp3'), time.strftime('%Y-%m-%d', time.localtime(now)), now),
+    ]:
+        index.Update({'Path': path, 'Size': 1, 'Mtime': mtime, 'Errors': [], 'Created': created})
+    retention = download.Retention('/', index, {'Playlists': {
+        os.path.join('openuni', '1-culture-as-polytics'): {},
+        os.path.join('grazhdanin-tv', 'shlosberg-live'): {},
+    }})
+    assert [os.path.basename(entry['Path']) for entry in retention.Eligible()][0] == 'old.mp3'
+
+
+class FakeMp3Track(download.Track):
+    def Download(self, filename, retention=None):
+        with open(filename, 'wb') as f:
+            f.write(b'\xff\xfb\x90\x00' + b'\x00' * 413)
+
+    def Tag(self, filename):
+        pass
+
+
+def test_RetentionKeepsNewestEpisodes():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        playlistDir = os.path.join('grazhdanin-tv', 'shlosberg-live')
+        os.makedirs(os.path.join(tmpDir, playlistDir))
+        index = download.ArchiveIndex(None)
+        retention = download.Retention(tmpDir, index, {'Playlists': {playlistDir: {'KeepLast': 3}}})
+        created = ['2018-09-{:02}'.format(day) for day in range(10, 0, -1)] # newest first, as in ShlosbergLive.Urls
+        for date in created + ['2018-09-11']:
+            track = FakeMp3Track()
+            track.SetEverything(
+                title=date,
+                created=date,
+                permalink='live',
+                artistEng='grazhdanin-tv',
+                playlist='shlosberg-live',
+                audioFormat='mp3',
+            )
+            track.Save(tmpDir, index=index, retention=retention)
+        assert sorted(os.listdir(os.path.join(tmpDir, playlistDir))) == [
+            '2018-09-09-live.mp3',
+            '2018-09-10-live.mp3',
+            '2018-09-11-live.mp3',
+        ]
+        assert [entry['Created'] for entry in index.Stored()] == ['2018-09-09', '2018-09-10', '2018-09-11']
+        assert index.IsEvicted(os.path.join(playlistDir, '2018-09-08-live.mp3'))
+    finally:
+        shutil.rmtree(tmpDir)
+
+
 if __name__ == '__main__':
     logging.basicConfig(
         level=logging.INFO,
@@ -194,4 +450,14 @@ if __name__ == '__main__':
     )
 
     test_ParseTitle()
+    test_CatalogRoundTrip()
+    test_ScanMp3()
+    test_VerifyArchiveUnicodePath()
+    test_RetentionKeepLast()
+    test_RetentionReserveOverQuota()
+    test_RetentionEligibleAcrossPlaylists()
+    test_RetentionKeepsNewestEpisodes()
+    test_Mp4ConvertCommand()
+    test_Mp4ReserveFailureRemovesTmpFile()
+    test_PrefixMatcher()
     log.info('ok')